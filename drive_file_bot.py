@@ -1,21 +1,33 @@
 import os
+import io
+import functools
 import json
-import uuid
+import fcntl
+import urllib.parse
+import hashlib
+import asyncio
+import secrets
 import threading
-import tempfile
-from flask import Flask, request, render_template_string
-from werkzeug.utils import secure_filename
-from pathlib import Path
+import concurrent.futures
+import time
+import httpx
+import redis.asyncio as redis
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import Quart, request
 
 # Load .env file
 from dotenv import load_dotenv
 load_dotenv()
 
+import httplib2
+import google_auth_httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, MediaUpload
 
-from telegram import Update, Bot # Ensure Bot is explicitly imported here
+from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -29,6 +41,10 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 GDRIVE_CREDENTIALS = os.getenv("GDRIVE_CREDENTIALS")
 GDRIVE_FOLDER_ID = os.getenv("GDRIVE_FOLDER_ID")
 BASE_URL = os.getenv("BASE_URL", "").rstrip("/")
+REDIS_URL = os.getenv("REDIS_URL")
+# Sharing the folder itself lets anyone with its link list every user's uploads,
+# so it is opt-in; by default each file is shared on its own.
+SHARE_FOLDER = os.getenv("SHARE_FOLDER", "").lower() in ("1", "true", "yes")
 
 if not BOT_TOKEN:
     raise Exception("BOT_TOKEN missing")
@@ -36,78 +52,506 @@ if not GDRIVE_CREDENTIALS:
     raise Exception("GDRIVE_CREDENTIALS missing")
 if not GDRIVE_FOLDER_ID:
     raise Exception("GDRIVE_FOLDER_ID missing")
+if not BASE_URL:
+    raise Exception("BASE_URL missing")
+
+# Every worker must register the same secret, so derive it from the token by default.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+
+# -------------------- DRIVE --------------------
+@functools.lru_cache(maxsize=1)
+def get_credentials():
+    # Parsing the service account's RSA key is the slow part; do it once per process.
+    return service_account.Credentials.from_service_account_info(
+        json.loads(GDRIVE_CREDENTIALS),
+        scopes=["https://www.googleapis.com/auth/drive"]
+    )
 
-creds_json = json.loads(GDRIVE_CREDENTIALS)
-creds = service_account.Credentials.from_service_account_info(
-    creds_json,
-    scopes=["https://www.googleapis.com/auth/drive"]
-)
-drive_service = build("drive", "v3", credentials=creds, static_discovery=False)
-
-# [CHANGE]: Removed the global 'bot' object initialization (bot = Bot(token=BOT_TOKEN))
-# This is to prevent potential conflicts with ApplicationBuilder's internal initialization.
-
-# -------------------- FLASK --------------------
-app = Flask(__name__)
-UPLOAD_FOLDER = tempfile.gettempdir()
-Path(UPLOAD_FOLDER).mkdir(exist_ok=True)
+# httplib2.Http is not thread-safe, so every thread that talks to Drive keeps
+# its own client and reuses its open connection instead of a new TLS handshake
+# per call. The bundled discovery document avoids a fetch per client.
+_drive_local = threading.local()
+# All blocking Drive work runs here, off the event loop; the pool size also
+# bounds how many per-thread clients exist.
+DRIVE_WORKERS = 8
+DRIVE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DRIVE_WORKERS, thread_name_prefix="drive")
+
+def get_drive_http():
+    http = getattr(_drive_local, "http", None)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=60))
+        _drive_local.http = http
+    return http
+
+def get_drive_service():
+    service = getattr(_drive_local, "service", None)
+    if service is None:
+        service = build("drive", "v3", http=get_drive_http(), static_discovery=True, cache_discovery=False)
+        _drive_local.service = service
+    return service
+
+# Telegram downloads are read in 1 MiB pieces and piped straight into Drive,
+# so a file never touches the disk or sits whole in memory.
+READ_SIZE = 1024 * 1024
+# Every Drive chunk is a full HTTP round-trip, so send as few as possible.
+DRIVE_CHUNK_SIZE = 100 * 1024 * 1024
+# Telegram files (<= 20 MiB) go up in smaller chunks so Drive starts receiving
+# the file while the rest is still downloading. Below SIMPLE_UPLOAD_LIMIT they
+# are fetched into memory and sent as one multipart request instead.
+PIPE_CHUNK_SIZE = 8 * 1024 * 1024
+SIMPLE_UPLOAD_LIMIT = 5 * 1024 * 1024
+# A 64 KiB default pipe means the Drive thread assembles each chunk from
+# hundreds of tiny reads; 1 MiB is the unprivileged Linux maximum.
+PIPE_BUFFER_SIZE = 1024 * 1024
+DRIVE_RETRIES = 3
+
+# Web uploads go from the browser straight into a Drive resumable session;
+# this server only opens the session and reports the finished file.
+MAX_UPLOAD_SIZE = 5 * 1024 ** 3
+# The browser PUTs smaller slices (a multiple of Drive's 256 KiB unit) so the
+# page can show progress and a dropped connection only costs one slice.
+BROWSER_CHUNK_SIZE = 8 * 1024 * 1024
+DRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&fields=id"
+# Drive only accepts the browser's cross-origin PUTs from the origin that opened the session.
+BASE_ORIGIN = "{0.scheme}://{0.netloc}".format(urllib.parse.urlsplit(BASE_URL))
+
+def start_resumable_upload(name, mimetype, size):
+    """Open a Drive resumable session for the browser to PUT the file into."""
+    resp, content = get_drive_http().request(
+        DRIVE_UPLOAD_URL,
+        "POST",
+        body=json.dumps({"name": name, "parents": [GDRIVE_FOLDER_ID]}),
+        headers={
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Type": mimetype,
+            "X-Upload-Content-Length": str(size),
+            "Origin": BASE_ORIGIN,
+        },
+    )
+    if resp.status != 200 or "location" not in resp:
+        raise HttpError(resp, content, uri=DRIVE_UPLOAD_URL)
+    return resp["location"]
+
+def find_upload(session_url, size):
+    """Look up the file a resumable session produced; None until it is complete.
+
+    The file id comes from Drive, never from the browser, so an upload link
+    can only ever publish the file its own session created.
+    """
+    resp, content = get_drive_http().request(
+        session_url, "PUT", body=b"", headers={"Content-Range": f"bytes */{size}"}
+    )
+    if resp.status not in (200, 201):
+        return None
+    file_id = json.loads(content)["id"]
+    resp = get_drive_service().files().get(
+        fileId=file_id, fields="id, parents, webContentLink, webViewLink"
+    ).execute(num_retries=DRIVE_RETRIES)
+    if GDRIVE_FOLDER_ID not in resp.get("parents", []):
+        return None
+    if not folder_shared.is_set():
+        share_file(file_id)
+    return resp
+
+def file_exists(file_id):
+    """Whether a file the bot uploaded earlier is still in Drive and not trashed."""
+    try:
+        resp = get_drive_service().files().get(
+            fileId=file_id, fields="trashed"
+        ).execute(num_retries=DRIVE_RETRIES)
+    except HttpError as e:
+        if e.resp.status == 404:
+            return False
+        raise
+    return not resp.get("trashed", False)
+
+# Set once share_folder() succeeds; until then every file is shared on its own.
+folder_shared = threading.Event()
+
+def share_folder():
+    """Share the upload folder with anyone who has the link; new files inherit it."""
+    get_drive_service().permissions().create(
+        fileId=GDRIVE_FOLDER_ID,
+        body={"type": "anyone", "role": "reader"},
+        fields="id",
+        sendNotificationEmail=False,
+    ).execute(num_retries=DRIVE_RETRIES)
+    folder_shared.set()
+
+def share_file(file_id):
+    get_drive_service().permissions().create(
+        fileId=file_id, body={"type": "anyone", "role": "reader"}, fields="id"
+    ).execute(num_retries=DRIVE_RETRIES)
+
+def drive_upload(media, name):
+    """Upload media into the Drive folder, returning the file resource.
+
+    The create response already carries the links; the only other call is the
+    permission, skipped when the file inherits it from a shared folder.
+    """
+    metadata = {"name": name, "parents": [GDRIVE_FOLDER_ID]}
+    request_drive = get_drive_service().files().create(
+        body=metadata, media_body=media, fields="id, webContentLink, webViewLink"
+    )
 
-upload_sessions = {}
+    if not media.resumable():
+        resp = request_drive.execute(num_retries=DRIVE_RETRIES)
+    else:
+        resp = None
+        while resp is None:
+            status, resp = request_drive.next_chunk(num_retries=DRIVE_RETRIES)
+
+    if not folder_shared.is_set():
+        share_file(resp["id"])
+    return resp
+
+class StreamMediaUpload(MediaUpload):
+    """Resumable media read sequentially from a non-seekable stream (e.g. a pipe).
+
+    Pass size when it is known: with an unknown size the upload only ends on a
+    short read, and a stream that is an exact multiple of chunksize would end
+    with an empty, malformed chunk.
+    """
+
+    def __init__(self, fd, mimetype, chunksize=DRIVE_CHUNK_SIZE, size=None):
+        super().__init__()
+        self._fd = fd
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._size = size
+        self.aborted = False
+        # The last chunk handed out, kept so Drive can ask for its tail again
+        # after a partial write or a retried request.
+        self._last_begin = 0
+        self._last = b""
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def close(self):
+        self._fd.close()
+
+    def getbytes(self, begin, length):
+        tail = self._last[begin - self._last_begin:]
+        data = tail + self._fd.read(length - len(tail))
+        # A short read normally finalizes the upload; never do that for a
+        # stream that was cut off half way.
+        if self.aborted:
+            raise IOError("upload aborted")
+        if self._size is not None and len(data) < length and begin + len(data) < self._size:
+            raise IOError("stream ended before its announced size")
+        self._last_begin, self._last = begin, data
+        return data
+
+class PipeUpload:
+    """Drive upload fed through a pipe: write() from one thread, DRIVE_POOL uploads."""
+
+    def __init__(self, name, mimetype, chunksize=DRIVE_CHUNK_SIZE, size=None):
+        rfd, wfd = os.pipe()
+        try:
+            fcntl.fcntl(wfd, fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+        except (AttributeError, OSError):
+            pass  # not Linux, or above /proc/sys/fs/pipe-max-size: keep the default
+        self._writer = os.fdopen(wfd, "wb")
+        reader = os.fdopen(rfd, "rb", buffering=PIPE_BUFFER_SIZE)
+        self._media = StreamMediaUpload(reader, mimetype, chunksize, size)
+        self._future = DRIVE_POOL.submit(self._upload, name)
+
+    def write(self, chunk):
+        self._writer.write(chunk)
+
+    def close(self):
+        try:
+            self._writer.close()
+        except BrokenPipeError:
+            pass  # the upload already failed; wait() reports why
+
+    def abort(self):
+        if not self._writer.closed:
+            self._media.aborted = True
+            self.close()
+
+    def _upload(self, name):
+        try:
+            return drive_upload(self._media, name)
+        finally:
+            # Closing the read end makes a blocked writer fail fast instead of hanging.
+            self._media.close()
+
+    async def wait(self):
+        # The writer never finished: don't publish a truncated file. Closing
+        # flushes into a possibly full pipe, so do it off the loop.
+        await asyncio.to_thread(self.abort)
+        return await asyncio.wrap_future(self._future)
+
+# -------------------- WEB --------------------
+UPLOAD_TOKEN_TTL = 3600
+LOCAL_STORE_MAX_ENTRIES = 10000
+
+class SessionStore:
+    """Expiring key/value store shared through Redis when REDIS_URL is set.
+
+    Without Redis the values live in this process only, which is fine for a
+    single worker but not behind gunicorn -w N or several instances. Every key
+    has the same ttl, so the local dict is kept in expiry order: set() drops
+    expired entries from its front, and the soonest to expire once it is full.
+    """
+
+    def __init__(self, client=None, prefix="upl:", ttl=UPLOAD_TOKEN_TTL):
+        self._client = client
+        self._prefix = prefix
+        self._ttl = ttl
+        self._local = {}
+
+    async def set(self, key, value):
+        if self._client:
+            await self._client.setex(self._prefix + key, self._ttl, value)
+        else:
+            now = time.monotonic()
+            self._local.pop(key, None)
+            while self._local:
+                oldest = next(iter(self._local))
+                if self._local[oldest][0] >= now and len(self._local) < LOCAL_STORE_MAX_ENTRIES:
+                    break
+                del self._local[oldest]
+            self._local[key] = (now + self._ttl, str(value))
+
+    async def get(self, key):
+        if not key:
+            return None
+        if self._client:
+            value = await self._client.get(self._prefix + key)
+            return value.decode() if value is not None else None
+        expires, value = self._local.get(key, (0, None))
+        if expires < time.monotonic():
+            self._local.pop(key, None)
+            return None
+        return value
+
+    async def add(self, key, value):
+        """set() only if key is not there yet; whether it was set."""
+        if self._client:
+            return bool(await self._client.set(self._prefix + key, value, ex=self._ttl, nx=True))
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, value)
+        return True
+
+    async def delete(self, key):
+        if self._client:
+            await self._client.delete(self._prefix + key)
+        else:
+            self._local.pop(key, None)
+
+# A stalled Redis must not freeze the bot and the web server sharing its loop.
+REDIS_TIMEOUT = 5
+redis_client = redis.Redis.from_url(
+    REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+) if REDIS_URL else None
+upload_sessions = SessionStore(redis_client)
+# The Drive session each upload link opened; a link opens at most one.
+drive_sessions = SessionStore(redis_client, prefix="upldrive:")
+# Telegram gives identical files the same file_unique_id, so a file someone has
+# already sent is answered from here without downloading or uploading it again.
+uploaded_files = SessionStore(redis_client, prefix="drivefile:", ttl=30 * 86400)
 
 UPLOAD_HTML = """
 <h2>Upload to Google Drive</h2>
 <p>User: {{user}}</p>
-<form method="POST" enctype="multipart/form-data">
-    <input type="hidden" name="token" value="{{token}}">
+<form id="form">
     <input type="file" name="file" required><br><br>
     <button type="submit">Upload</button>
 </form>
+<p id="status"></p>
+<script>
+const CHUNK = {{chunk_size}};
+const RETRIES = 5;
+const form = document.getElementById("form");
+const out = document.getElementById("status");
+form.onsubmit = async (e) => {
+    e.preventDefault();
+    const file = form.file.files[0];
+    try {
+        const start = await fetch(`upload/session${location.search}`, {
+            method: "POST",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({name: file.name, size: file.size, mimeType: file.type}),
+        });
+        if (!start.ok) { out.textContent = await start.text(); return; }
+        const {url} = await start.json();
+
+        // Drive answers 308 until the last chunk is in, then 200 with the file.
+        // Its Range header ("bytes=0-N") says how much it kept; resume from there.
+        // After a network error or a 5xx, ask Drive what it has ("bytes */size")
+        // and carry on from there instead of starting over.
+        let res, offset = 0, failures = 0, lost = false;
+        const progress = () => { out.textContent = `Uploading… ${Math.round(offset * 100 / (file.size || 1))}%`; };
+        progress();
+        for (;;) {
+            const end = Math.min(offset + CHUNK, file.size);
+            const query = lost;
+            const range = query || !file.size ? `bytes */${file.size}` : `bytes ${offset}-${end - 1}/${file.size}`;
+            try {
+                res = await fetch(url, {method: "PUT", headers: {"Content-Range": range}, body: query ? null : file.slice(offset, end)});
+            } catch (err) {
+                res = null;
+            }
+            if (res && res.ok) break;
+            if (res && res.status === 308) {
+                // A 308 without Range means Drive kept nothing of this PUT:
+                // leave offset alone so the same chunk is sent again. Answering
+                // a query, it means Drive has nothing at all.
+                const kept = res.headers.get("Range"), before = offset;
+                if (kept) offset = Number(kept.split("-")[1]) + 1;
+                else if (query) offset = 0;
+                lost = false;
+                if (offset > before) failures = 0;
+                else if (!query && ++failures > RETRIES) { out.textContent = "Upload failed."; return; }
+                progress();
+                continue;
+            }
+            if ((res && res.status < 500) || ++failures > RETRIES) { out.textContent = "Upload failed."; return; }
+            lost = true;
+            out.textContent = "Connection lost, retrying…";
+            await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** failures));
+        }
+
+        const done = await fetch(`upload/done${location.search}`, {method: "POST"});
+        out.textContent = await done.text();
+    } catch (err) {
+        out.textContent = "Upload failed.";
+    }
+};
+</script>
 """
 
-@app.route("/upload", methods=["GET", "POST"])
-def upload():
-    token = request.values.get("token")
-    if token not in upload_sessions:
-        return "Invalid or expired upload link."
-
-    user_id = upload_sessions[token]
-
-    if request.method == "GET":
-        return render_template_string(UPLOAD_HTML, token=token, user=user_id)
-
-    file = request.files["file"]
-    filename = secure_filename(file.filename)
-    temp_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(temp_path)
-
-    media = MediaFileUpload(temp_path, chunksize=10*1024*1024, resumable=True)
-    metadata = {"name": filename, "parents": [GDRIVE_FOLDER_ID]}
-
-    request_drive = drive_service.files().create(
-        body=metadata, media_body=media, fields="id, webContentLink, webViewLink"
-    )
+def make_upload_app(application):
+    """Quart app serving the web upload page and the Telegram webhook."""
+    app = Quart(__name__)
+    # Parsed once; Quart's Jinja environment is async, hence render_async() below.
+    upload_template = app.jinja_env.from_string(UPLOAD_HTML)
+
+    @app.route("/upload")
+    async def upload():
+        token = request.args.get("token")
+        user_id = await upload_sessions.get(token)
+        if user_id is None:
+            return "Invalid or expired upload link."
+
+        return await upload_template.render_async(user=user_id, chunk_size=BROWSER_CHUNK_SIZE)
+
+    @app.route("/upload/session", methods=["POST"])
+    async def upload_session():
+        token = request.args.get("token")
+        if await upload_sessions.get(token) is None:
+            return "Invalid or expired upload link.", 403
+
+        info = await request.get_json(silent=True)
+        if not isinstance(info, dict):
+            return "Bad request.", 400
+        size, name, mimetype = info.get("size"), info.get("name"), info.get("mimeType")
+        if type(size) is not int or size < 0:
+            return "Bad request.", 400
+        if size > MAX_UPLOAD_SIZE:
+            return "File too large (max 5 GB).", 413
+
+        # Only Drive metadata, never a local path: keep the name as given, like Telegram's.
+        if not isinstance(name, str) or not name:
+            name = "file"
+        if not isinstance(mimetype, str) or not mimetype:
+            mimetype = "application/octet-stream"
+        if not await drive_sessions.add(token, ""):
+            return "This link was already used to start an upload.", 409
+        loop = asyncio.get_running_loop()
+        try:
+            url = await loop.run_in_executor(DRIVE_POOL, start_resumable_upload, name, mimetype, size)
+        except BaseException:
+            await drive_sessions.delete(token)
+            raise
+        await drive_sessions.set(token, json.dumps({"url": url, "size": size}))
+        return {"url": url}
+
+    @app.route("/upload/done", methods=["POST"])
+    async def upload_done():
+        token = request.args.get("token")
+        user_id = await upload_sessions.get(token)
+        if user_id is None:
+            return "Invalid or expired upload link.", 403
+
+        session = await drive_sessions.get(token)
+        if not session:
+            return "No upload was started with this link.", 409
+        session = json.loads(session)
+
+        loop = asyncio.get_running_loop()
+        resp = await loop.run_in_executor(DRIVE_POOL, find_upload, session["url"], session["size"])
+        if resp is None:
+            return "Upload not finished.", 409
+        link = resp.get("webContentLink") or resp.get("webViewLink")
 
-    resp = None
-    while resp is None:
-        status, resp = request_drive.next_chunk()
+        await upload_sessions.delete(token)
+        await drive_sessions.delete(token)
 
-    file_id = resp["id"]
-    drive_service.permissions().create(
-        fileId=file_id, body={"type": "anyone", "role": "reader"}
-    ).execute()
+        # The web app runs on the bot's event loop, so its bot (and HTTP pool) can be used directly.
+        await application.bot.send_message(chat_id=user_id, text=f"✅ Uploaded Successfully!\n{link}")
 
-    link = resp.get("webContentLink") or resp.get("webViewLink")
+        return "Upload completed. Check Telegram."
 
-    os.remove(temp_path)
-    upload_sessions.pop(token, None)
+    @app.route("/tg", methods=["POST"])
+    async def telegram_webhook():
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            return "Forbidden", 403
 
-    # [CLEANUP]: Create a new Bot instance to send the final message.
-    # This avoids using the application's internal bot outside of the telegram loop.
-    Bot(BOT_TOKEN).send_message(chat_id=user_id, text=f"✅ Uploaded Successfully!\n{link}")
+        await application.update_queue.put(Update.de_json(await request.get_json(), application.bot))
+        return ""
 
-    return "Upload completed. Check Telegram."
+    return app
 
 # -------------------- TELEGRAM --------------------
+# A piped upload holds a DRIVE_POOL worker for as long as it reads its pipe.
+# Queued readers would leave their writers blocked on full pipes, holding the
+# threads the running uploads' writers need, so never queue more streams than
+# the pool can run at once; two workers stay free for the short Drive calls.
+pipe_upload_slots = asyncio.Semaphore(DRIVE_WORKERS - 2)
+
+async def stream_to_drive(client, tg_file, name, mimetype, size):
+    """Pipe a Telegram download into Drive while it is still arriving."""
+    async with pipe_upload_slots:
+        return await _stream_to_drive(client, tg_file, name, mimetype, size)
+
+async def _stream_to_drive(client, tg_file, name, mimetype, size):
+    upload = PipeUpload(name, mimetype, PIPE_CHUNK_SIZE, size)
+    try:
+        # tg_file.file_path embeds the bot token, so errors never quote the URL.
+        async with client.stream("GET", tg_file.file_path) as r:
+            if r.is_error:
+                raise RuntimeError(f"Telegram download failed (HTTP {r.status_code})")
+            async for chunk in r.aiter_bytes(READ_SIZE):
+                # Writes block once Drive falls behind, so keep them off the loop.
+                await asyncio.to_thread(upload.write, chunk)
+        await asyncio.to_thread(upload.close)
+    except BrokenPipeError:
+        pass  # Drive upload failed; wait() re-raises the real error
+    except httpx.HTTPError as e:
+        asyncio.get_running_loop().run_in_executor(None, upload.abort)
+        raise RuntimeError(f"Telegram download failed ({type(e).__name__})") from None
+    except BaseException:
+        # abort() waits for any write still running in its thread; don't
+        # hold up the loop (or a cancellation) for it.
+        asyncio.get_running_loop().run_in_executor(None, upload.abort)
+        raise
+    return await upload.wait()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Send me a file.\nLarge files → Web upload link.")
 
@@ -123,60 +567,92 @@ async def file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Small file → direct upload
     if hasattr(file_obj, "file_size") and file_obj.file_size <= 20 * 1024 * 1024:
+        cached = await uploaded_files.get(file_obj.file_unique_id)
+        if cached:
+            file_id, link = cached.split("|", 1)
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(DRIVE_POOL, file_exists, file_id):
+                await msg.reply_text(f"Uploaded!\n{link}")
+                return
+            # Deleted or trashed in Drive since: upload it again.
+            await uploaded_files.delete(file_obj.file_unique_id)
+
         await msg.reply_text("Uploading small file to Drive...")
 
+        name = getattr(file_obj, "file_name", None) or "file"
+        mimetype = getattr(file_obj, "mime_type", None) or "application/octet-stream"
         tg_file = await file_obj.get_file()
-        temp_path = f"/tmp/{uuid.uuid4().hex}"
-        await tg_file.download_to_drive(temp_path)
-
-        media = MediaFileUpload(temp_path, resumable=True)
-        metadata = {"name": getattr(file_obj, "file_name", "file"), "parents": [GDRIVE_FOLDER_ID]}
-
-        request_drive = drive_service.files().create(
-            body=metadata, media_body=media, fields="id, webContentLink, webViewLink"
-        )
-
-        resp = None
-        while resp is None:
-            status, resp = request_drive.next_chunk()
-
-        drive_service.permissions().create(
-            fileId=resp["id"], body={"type": "anyone", "role": "reader"}
-        ).execute()
+        if file_obj.file_size <= SIMPLE_UPLOAD_LIMIT:
+            buf = await tg_file.download_as_bytearray()
+            media = MediaIoBaseUpload(io.BytesIO(buf), mimetype, resumable=False)
+            loop = asyncio.get_running_loop()
+            resp = await loop.run_in_executor(DRIVE_POOL, drive_upload, media, name)
+        else:
+            resp = await stream_to_drive(
+                context.bot_data["tg_download"], tg_file, name, mimetype, file_obj.file_size
+            )
 
         link = resp.get("webContentLink") or resp.get("webViewLink")
+        await uploaded_files.set(file_obj.file_unique_id, f"{resp['id']}|{link}")
 
-        os.remove(temp_path)
         await msg.reply_text(f"Uploaded!\n{link}")
         return
 
     # Large file → give link
-    token = uuid.uuid4().hex
-    upload_sessions[token] = user_id
+    token = secrets.token_urlsafe(16)
+    await upload_sessions.set(token, user_id)
 
     upload_url = f"{BASE_URL}/upload?token={token}"
 
     await msg.reply_text(f"Large file.\nUpload here:\n{upload_url}")
 
-# -------------------- MAIN --------------------
-def main():
-    port = int(os.getenv("PORT", 5000))
-
-    # We must ensure Flask is run in a separate thread before application.run_polling() starts
-    threading.Thread(
-        target=lambda: app.run(host="0.0.0.0", port=port, debug=False),
-        daemon=True
-    ).start()
-    
-    # This is the standard, correct initialization for v20.x
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
-
+def register_handlers(application):
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, file_handler))
 
-    print("BOT RUNNING…")
-    application.run_polling()
+# -------------------- MAIN --------------------
+async def run(port):
+    config = Config()
+    config.bind = [f"0.0.0.0:{port}"]
+
+    # Updates arrive through the /tg webhook on the web app, so no polling Updater.
+    # PTB handles one update at a time by default; let uploads from different
+    # users run side by side (stream_to_drive bounds the Drive side itself).
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .updater(None)
+        .concurrent_updates(True)
+        .build()
+    )
+    register_handlers(application)
+    app = make_upload_app(application)
+
+    # With SHARE_FOLDER, uploaded files inherit the folder's anyone-with-link permission.
+    if SHARE_FOLDER:
+        try:
+            await asyncio.get_running_loop().run_in_executor(DRIVE_POOL, share_folder)
+        except HttpError as e:
+            print(f"Could not share the Drive folder, sharing each file instead: {e}")
+
+    # The web server and the bot share one event loop; serve() returns on SIGINT/SIGTERM.
+    async with httpx.AsyncClient(timeout=60) as tg_download, application:
+        application.bot_data["tg_download"] = tg_download
+        await application.bot.set_webhook(
+            url=f"{BASE_URL}/tg", secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES
+        )
+        await application.start()
+        print("BOT RUNNING…")
+        try:
+            await serve(app, config)
+        finally:
+            await application.stop()
+            if redis_client:
+                await redis_client.aclose()
+
+def main():
+    port = int(os.getenv("PORT", 5000))
+    asyncio.run(run(port))
 
 if __name__ == "__main__":
     main()
-